@@ -1,12 +1,15 @@
 #! /somewhere/python3
 from contextlib import contextmanager, _GeneratorContextManager
 from queue import Queue, Empty
-from typing import Tuple, Any, Callable, Dict, Iterator, Optional, List
+from typing import Tuple, Any, Callable, Dict, Iterator, Optional, List, Union
 from xml.sax.saxutils import XMLGenerator
 import _thread
 import atexit
 import base64
 import codecs
+import concurrent.futures
+import errno
+import itertools
 import os
 import pathlib
 import ptpython.repl
@@ -84,6 +87,10 @@ CHAR_TO_KEY = {
     ")": "shift-0x0B",
 }
 
+RUN_VM_RE = re.compile(r"run-(.+)-vm$")
+UNIT_LINE_RE = re.compile(r"^([^=]+)=(.*)$")
+WORD_RE = re.compile(r"^\w+$")
+
 # Forward references
 nr_tests: int
 failed_tests: list
@@ -99,16 +106,51 @@ def make_command(args: list) -> str:
     return " ".join(map(shlex.quote, (map(str, args))))
 
 
+def port_check_command(port: int) -> str:
+    """Shell command that succeeds iff a TCP connection to the given port
+    on localhost can be opened. Uses bash's /dev/tcp, so that no process
+    needs to be spawned in the guest.
+    """
+    return ": 2> /dev/null < /dev/tcp/localhost/{}".format(port)
+
+
+def copy_file(src: Union[str, pathlib.Path], dst: Union[str, pathlib.Path]) -> str:
+    """Like shutil.copy2, but let the kernel copy the data with sendfile(),
+    falling back to copying in large blocks where that is not supported.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            # Only fall back if sendfile() is not supported for these files
+            # at all; real I/O errors such as ENOSPC are passed on.
+            if offset != 0 or e.errno not in (
+                errno.ENOTSOCK,
+                errno.EINVAL,
+                errno.ENOSYS,
+            ):
+                raise
+            shutil.copyfileobj(fsrc, fdst, 4 * 1024 * 1024)
+    shutil.copystat(src, dst)
+    return str(dst)
+
+
 def create_vlan(vlan_nr: str) -> Tuple[str, str, "subprocess.Popen[bytes]", Any]:
-    global log
-    log.log("starting VDE switch for network {}".format(vlan_nr))
+    # This does not log, so that several switches can be started
+    # concurrently from different threads.
     vde_socket = tempfile.mkdtemp(
         prefix="nixos-test-vde-", suffix="-vde{}.ctl".format(vlan_nr)
     )
     pty_master, pty_slave = pty.openpty()
     vde_process = subprocess.Popen(
         ["vde_switch", "-s", vde_socket, "--dirmode", "0700"],
-        bufsize=1,
+        bufsize=65536,
         stdin=pty_slave,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -126,15 +168,19 @@ def create_vlan(vlan_nr: str) -> Tuple[str, str, "subprocess.Popen[bytes]", Any]
     return (vlan_nr, vde_socket, vde_process, fd)
 
 
-def retry(fn: Callable) -> None:
-    """Call the given function repeatedly, with 1 second intervals,
-    until it returns True or a timeout is reached.
+def retry(fn: Callable, timeout: int = 900) -> None:
+    """Call the given function repeatedly, with exponentially growing
+    intervals (starting at 50ms, capped at 1 second), until it returns
+    True or a timeout is reached.
     """
 
-    for _ in range(900):
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while time.monotonic() < deadline:
         if fn(False):
             return
-        time.sleep(1)
+        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 2, 1.0)
 
     if not fn(True):
         raise Exception("action timed out")
@@ -212,7 +258,7 @@ class Machine:
             self.name = "machine"
             cmd = args.get("startCommand", None)
             if cmd:
-                match = re.search("run-(.+)-vm$", cmd)
+                match = RUN_VM_RE.search(cmd)
                 if match:
                     self.name = match.group(1)
 
@@ -226,6 +272,7 @@ class Machine:
             return path
 
         self.state_dir = create_dir("vm-state-{}".format(self.name))
+        self.screen_dump = os.path.join(self.state_dir, "screen.ppm")
         self.shared_dir = create_dir("shared-xchg")
 
         self.booted = False
@@ -235,6 +282,13 @@ class Machine:
         self.monitor: Optional[socket.socket] = None
         self.logger: Logger = args["log"]
         self.allow_reboot = args.get("allowReboot", False)
+        self.transfer_dir: Optional[pathlib.Path] = None
+        self.transfer_count = itertools.count()
+        # Reused for all reads from the monitor and shell sockets. Each
+        # socket has its own buffer so that they can be read from different
+        # threads.
+        self.monitor_view = memoryview(bytearray(65536))
+        self.shell_view = memoryview(bytearray(65536))
 
     @staticmethod
     def create_startcommand(args: Dict[str, str]) -> str:
@@ -300,15 +354,15 @@ class Machine:
 
     def wait_for_monitor_prompt(self) -> str:
         assert self.monitor is not None
-        answer = ""
+        answer = bytearray()
         while True:
-            undecoded_answer = self.monitor.recv(1024)
-            if not undecoded_answer:
+            n = self.monitor.recv_into(self.monitor_view)
+            if not n:
                 break
-            answer += undecoded_answer.decode()
-            if answer.endswith("(qemu) "):
+            answer += self.monitor_view[:n]
+            if answer.endswith(b"(qemu) "):
                 break
-        return answer
+        return answer.decode()
 
     def send_monitor_command(self, command: str) -> str:
         message = ("{}\n".format(command)).encode()
@@ -324,16 +378,14 @@ class Machine:
         """
 
         def check_active(_: Any) -> bool:
-            info = self.get_unit_info(unit, user)
-            state = info["ActiveState"]
+            state = self.get_unit_property(unit, "ActiveState", user)
             if state == "failed":
                 raise Exception('unit "{}" reached state "{}"'.format(unit, state))
 
             if state == "inactive":
                 status, jobs = self.systemctl("list-jobs --full 2>&1", user)
                 if "No jobs" in jobs:
-                    info = self.get_unit_info(unit, user)
-                    if info["ActiveState"] == state:
+                    if self.get_unit_property(unit, "ActiveState", user) == state:
                         raise Exception(
                             (
                                 'unit "{}" is inactive and there ' "are no pending jobs"
@@ -353,18 +405,36 @@ class Machine:
                 )
             )
 
-        line_pattern = re.compile(r"^([^=]+)=(.*)$")
-
         def tuple_from_line(line: str) -> Tuple[str, str]:
-            match = line_pattern.match(line)
+            match = UNIT_LINE_RE.match(line)
             assert match is not None
             return match[1], match[2]
 
         return dict(
             tuple_from_line(line)
             for line in lines.split("\n")
-            if line_pattern.match(line)
+            if UNIT_LINE_RE.match(line)
+        )
+
+    def get_unit_property(
+        self, unit: str, prop: str, user: Optional[str] = None
+    ) -> str:
+        """Retrieve a single property of a unit. Cheaper than get_unit_info
+        when only one value is needed.
+        """
+        status, value = self.systemctl(
+            '--no-pager show -p {} --value "{}"'.format(prop, unit), user
         )
+        if status != 0:
+            raise Exception(
+                'retrieving systemctl property "{}" for unit "{}" {} failed with exit code {}'.format(
+                    prop,
+                    unit,
+                    "" if user is None else 'under user "{}"'.format(user),
+                    status,
+                )
+            )
+        return value.rstrip("\n")
 
     def systemctl(self, q: str, user: Optional[str] = None) -> Tuple[int, str]:
         if user is not None:
@@ -395,18 +465,37 @@ class Machine:
 
         out_command = "( {} ); echo '|!EOF' $?\n".format(command)
         self.shell.send(out_command.encode())
+        return self.read_command_output()
 
-        output = ""
-        status_code_pattern = re.compile(r"(.*)\|\!EOF\s+(\d+)")
+    def read_command_output(self) -> Tuple[int, str]:
+        """Read the output of a command sent to the shell up to the end
+        marker, and return it together with the command's exit status.
+        """
+        # Only scan the newly received bytes for the end marker, so that
+        # large outputs are not searched over and over again. The marker
+        # only counts if it is followed by an exit status and a newline,
+        # as the command's own output may contain it as well.
+        eof_marker = b"|!EOF "
+        output = bytearray()
+        search_from = 0
 
         while True:
-            chunk = self.shell.recv(4096).decode(errors="ignore")
-            match = status_code_pattern.match(chunk)
-            if match:
-                output += match[1]
-                status_code = int(match[2])
-                return (status_code, output)
-            output += chunk
+            n = self.shell.recv_into(self.shell_view)
+            output += self.shell_view[:n]
+            while True:
+                eof = output.find(eof_marker, search_from)
+                if eof < 0:
+                    search_from = max(search_from, len(output) - len(eof_marker) + 1)
+                    break
+                end = output.find(b"\n", eof)
+                status = output[eof + len(eof_marker) : end if end >= 0 else None]
+                if end < 0 and (status.isdigit() or not status):
+                    # Wait for the rest of the line
+                    search_from = eof
+                    break
+                if end >= 0 and status.isdigit():
+                    return (int(status), output[:eof].decode(errors="ignore"))
+                search_from = eof + 1
 
     def succeed(self, *commands: str) -> str:
         """Execute each command and check that it succeeds."""
@@ -474,6 +563,9 @@ class Machine:
             self.booted = False
             self.connected = False
 
+            if os.path.exists(self.screen_dump):
+                os.unlink(self.screen_dump)
+
     def get_tty_text(self, tty: str) -> str:
         status, output = self.execute(
             "fold -w$(stty -F /dev/tty{0} size | "
@@ -516,7 +608,7 @@ class Machine:
 
     def wait_for_open_port(self, port: int) -> None:
         def port_is_open(_: Any) -> bool:
-            status, _ = self.execute("nc -z localhost {}".format(port))
+            status, _ = self.execute(port_check_command(port))
             return status == 0
 
         with self.nested("waiting for TCP port {}".format(port)):
@@ -524,7 +616,7 @@ class Machine:
 
     def wait_for_closed_port(self, port: int) -> None:
         def port_is_closed(_: Any) -> bool:
-            status, _ = self.execute("nc -z localhost {}".format(port))
+            status, _ = self.execute(port_check_command(port))
             return status != 0
 
         retry(port_is_closed)
@@ -556,8 +648,7 @@ class Machine:
 
     def screenshot(self, filename: str) -> None:
         out_dir = os.environ.get("out", os.getcwd())
-        word_pattern = re.compile(r"^\w+$")
-        if word_pattern.match(filename):
+        if WORD_RE.match(filename):
             filename = os.path.join(out_dir, "{}.png".format(filename))
         tmp = "{}.ppm".format(filename)
 
@@ -566,7 +657,8 @@ class Machine:
             {"image": os.path.basename(filename)},
         ):
             self.send_monitor_command("screendump {}".format(tmp))
-            ret = subprocess.run("pnmtopng {} > {}".format(tmp, filename), shell=True)
+            with open(filename, "wb") as png:
+                ret = subprocess.run(["pnmtopng", tmp], stdout=png)
             os.unlink(tmp)
             if ret.returncode != 0:
                 raise Exception("Cannot convert screenshot")
@@ -576,60 +668,98 @@ class Machine:
         shell into the destination file. Works without host-guest shared folder.
         Prefer copy_from_host for whenever possible.
         """
-        with open(source, "rb") as fh:
-            content_b64 = base64.b64encode(fh.read()).decode()
-            self.succeed(
-                f"mkdir -p $(dirname {target})",
-                f"echo -n {content_b64} | base64 -d > {target}",
-            )
+        self.succeed(f"mkdir -p $(dirname {target})")
+        with self.nested("copying {} to {} via the shell".format(source, target)):
+            # Stream the file as a here-document, so that the host does not
+            # have to hold all of it and the command line is not limited by
+            # ARG_MAX (bash still collects the here-document in memory). The
+            # delimiter contains "-", which never occurs in base64 output.
+            delimiter = "END-OF-BASE64"
+            end = "{}\n); echo '|!EOF' $?\n".format(delimiter).encode()
+            with open(source, "rb") as fh:
+                self.shell.sendall(
+                    "( base64 -d > {} <<'{}'\n".format(target, delimiter).encode()
+                )
+                try:
+                    # A multiple of 3 bytes, so that no padding is emitted
+                    # in the middle of the stream.
+                    for chunk in iter(lambda: fh.read(48 * 1024), b""):
+                        self.shell.sendall(base64.encodebytes(chunk))
+                except BaseException:
+                    # Close the here-document, or the shell would take all
+                    # further commands as part of it.
+                    self.shell.sendall(end)
+                    self.read_command_output()
+                    raise
+            self.shell.sendall(end)
+            status, out = self.read_command_output()
+            if status != 0:
+                self.log("output: {}".format(out))
+                raise Exception(
+                    "copying `{}` failed (exit code {})".format(source, status)
+                )
+
+    def transfer_paths(self, name: str) -> Tuple[pathlib.Path, pathlib.Path]:
+        """Return a fresh intermediate path for copying `name` between host
+        and guest, both as seen from the host and from inside the VM. Each
+        copy gets its own numbered subdirectory, so that the basename is
+        kept, in one directory in `shared_dir` that is created on first use.
+        """
+        if self.transfer_dir is None:
+            self.transfer_dir = pathlib.Path(tempfile.mkdtemp(dir=self.shared_dir))
+            vm_transfer_dir = pathlib.Path("/tmp/shared") / self.transfer_dir.name
+            self.succeed(make_command(["mkdir", "-p", vm_transfer_dir]))
+        subdir = str(next(self.transfer_count))
+        (self.transfer_dir / subdir).mkdir()
+        return (
+            self.transfer_dir / subdir / name,
+            pathlib.Path("/tmp/shared") / self.transfer_dir.name / subdir / name,
+        )
 
     def copy_from_host(self, source: str, target: str) -> None:
         """Copy a file from the host into the guest via the `shared_dir` shared
-        among all the VMs (using a temporary directory).
+        among all the VMs (using a per-VM transfer directory).
         """
         host_src = pathlib.Path(source)
         vm_target = pathlib.Path(target)
-        with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
-            shared_temp = pathlib.Path(shared_td)
-            host_intermediate = shared_temp / host_src.name
-            vm_shared_temp = pathlib.Path("/tmp/shared") / shared_temp.name
-            vm_intermediate = vm_shared_temp / host_src.name
-
-            self.succeed(make_command(["mkdir", "-p", vm_shared_temp]))
+        host_intermediate, vm_intermediate = self.transfer_paths(host_src.name)
+        try:
+            self.succeed(make_command(["mkdir", "-p", vm_target.parent]))
             if host_src.is_dir():
-                shutil.copytree(host_src, host_intermediate)
+                shutil.copytree(host_src, host_intermediate, copy_function=copy_file)
             else:
-                shutil.copy(host_src, host_intermediate)
-            self.succeed("sync")
-            self.succeed(make_command(["mkdir", "-p", vm_target.parent]))
-            self.succeed(make_command(["cp", "-r", vm_intermediate, vm_target]))
+                copy_file(host_src, host_intermediate)
+            self.succeed(
+                "sync && " + make_command(["cp", "-r", vm_intermediate, vm_target])
+            )
+        finally:
+            shutil.rmtree(host_intermediate.parent)
         # Make sure the cleanup is synced into VM
         self.succeed("sync")
 
     def copy_from_vm(self, source: str, target_dir: str = "") -> None:
         """Copy a file from the VM (specified by an in-VM source path) to a path
         relative to `$out`. The file is copied via the `shared_dir` shared among
-        all the VMs (using a temporary directory).
+        all the VMs (using a per-VM transfer directory).
         """
         # Compute the source, target, and intermediate shared file names
         out_dir = pathlib.Path(os.environ.get("out", os.getcwd()))
         vm_src = pathlib.Path(source)
-        with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
-            shared_temp = pathlib.Path(shared_td)
-            vm_shared_temp = pathlib.Path("/tmp/shared") / shared_temp.name
-            vm_intermediate = vm_shared_temp / vm_src.name
-            intermediate = shared_temp / vm_src.name
+        intermediate, vm_intermediate = self.transfer_paths(vm_src.name)
+        try:
             # Copy the file to the shared directory inside VM
-            self.succeed(make_command(["mkdir", "-p", vm_shared_temp]))
-            self.succeed(make_command(["cp", "-r", vm_src, vm_intermediate]))
-            self.succeed("sync")
+            self.succeed(
+                make_command(["cp", "-r", vm_src, vm_intermediate]) + " && sync"
+            )
             abs_target = out_dir / target_dir / vm_src.name
             abs_target.parent.mkdir(exist_ok=True, parents=True)
             # Copy the file from the shared directory outside VM
             if intermediate.is_dir():
-                shutil.copytree(intermediate, abs_target)
+                shutil.copytree(intermediate, abs_target, copy_function=copy_file)
             else:
-                shutil.copy(intermediate, abs_target)
+                copy_file(intermediate, abs_target)
+        finally:
+            shutil.rmtree(intermediate.parent)
         # Make sure the cleanup is synced into VM
         self.succeed("sync")
 
@@ -647,29 +777,55 @@ class Machine:
             + "-contrast -normalize -despeckle -type grayscale "
             + "-sharpen 1 -posterize 3 -negate -gamma 100 "
             + "-blur 1x65535"
-        )
+        ).split()
 
-        tess_args = "-c debug_file=/dev/null --psm 11 --oem 2"
+        tess_args = "-c debug_file=/dev/null --psm 11 --oem 2".split()
 
         with self.nested("performing optical character recognition"):
-            with tempfile.NamedTemporaryFile() as tmpin:
-                self.send_monitor_command("screendump {}".format(tmpin.name))
-
-                cmd = "convert {} {} tiff:- | tesseract - - {}".format(
-                    magick_args, tmpin.name, tess_args
+            # QEMU overwrites the same file on every call
+            screen = self.screen_dump
+            self.send_monitor_command("screendump {}".format(screen))
+
+            # Pipe convert into tesseract directly, without a shell. The
+            # stderr of convert goes to a file, as nothing reads it while
+            # tesseract runs and a full pipe would block convert.
+            with tempfile.TemporaryFile() as convert_stderr:
+                convert = subprocess.Popen(
+                    ["convert", *magick_args, screen, "tiff:-"],
+                    stdout=subprocess.PIPE,
+                    stderr=convert_stderr,
                 )
-                ret = subprocess.run(cmd, shell=True, capture_output=True)
-                if ret.returncode != 0:
-                    raise Exception(
-                        "OCR failed with exit code {}".format(ret.returncode)
+                assert convert.stdout is not None
+                tesseract = subprocess.Popen(
+                    ["tesseract", "-", "-", *tess_args],
+                    stdin=convert.stdout,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+                convert.stdout.close()
+                stdout, tesseract_stderr = tesseract.communicate()
+                convert.wait()
+                convert_stderr.seek(0)
+                convert_errors = convert_stderr.read()
+            if convert.returncode != 0 or tesseract.returncode != 0:
+                self.log("convert: {}".format(convert_errors.decode(errors="ignore")))
+                self.log(
+                    "tesseract: {}".format(tesseract_stderr.decode(errors="ignore"))
+                )
+                raise Exception(
+                    "OCR failed with exit code {}".format(
+                        convert.returncode or tesseract.returncode
                     )
+                )
 
-                return ret.stdout.decode("utf-8")
+            return stdout.decode("utf-8")
 
     def wait_for_text(self, regex: str) -> None:
+        pattern = re.compile(regex)
+
         def screen_matches(last: bool) -> bool:
             text = self.get_screen_text()
-            matches = re.search(regex, text) is not None
+            matches = pattern.search(text) is not None
 
             if last and not matches:
                 self.log("Last OCR attempt failed. Text was: {}".format(text))
@@ -731,7 +887,7 @@ class Machine:
 
         self.process = subprocess.Popen(
             self.script,
-            bufsize=1,
+            bufsize=65536,
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
@@ -742,14 +898,31 @@ class Machine:
         self.monitor, _ = self.monitor_socket.accept()
         self.shell, _ = self.shell_socket.accept()
 
-        def process_serial_output() -> None:
-            assert self.process.stdout is not None
-            for _line in self.process.stdout:
-                # Ignore undecodable bytes that may occur in boot menus
-                line = _line.decode(errors="ignore").replace("\r", "").rstrip()
+        def log_serial_output(data: bytes) -> None:
+            # Ignore undecodable bytes that may occur in boot menus
+            text = data.decode(errors="ignore").replace("\r", "")
+            for _line in text.split("\n"):
+                line = _line.rstrip()
                 eprint("{} # {}".format(self.name, line))
                 self.logger.enqueue({"msg": line, "machine": self.name})
 
+        def process_serial_output() -> None:
+            assert self.process.stdout is not None
+            # Read whatever is available from the pipe and only split it
+            # into lines here, keeping an unterminated last line around
+            # until the rest of it arrives.
+            fd = self.process.stdout.fileno()
+            pending = b""
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                lines, newline, pending = (pending + data).rpartition(b"\n")
+                if newline:
+                    log_serial_output(lines)
+            if pending:
+                log_serial_output(pending)
+
         _thread.start_new_thread(process_serial_output, ())
 
         self.wait_for_monitor_prompt()
@@ -860,7 +1033,7 @@ def join_all() -> None:
 
 
 def test_script() -> None:
-    exec(os.environ["testScript"])
+    exec(compile(os.environ["testScript"], "<testScript>", "exec"))
 
 
 def run_tests() -> None:
@@ -869,7 +1042,8 @@ def run_tests() -> None:
     if tests is not None:
         with log.nested("running the VM test script"):
             try:
-                exec(tests, globals())
+                # Compile explicitly so that tracebacks name the script
+                exec(compile(tests, "<tests>", "exec"), globals())
             except Exception as e:
                 eprint("error: {}".format(str(e)))
                 sys.exit(1)
@@ -917,7 +1091,10 @@ if __name__ == "__main__":
     log = Logger()
 
     vlan_nrs = list(dict.fromkeys(os.environ.get("VLANS", "").split()))
-    vde_sockets = [create_vlan(v) for v in vlan_nrs]
+    for nr in vlan_nrs:
+        log.log("starting VDE switch for network {}".format(nr))
+    with concurrent.futures.ThreadPoolExecutor(max(len(vlan_nrs), 1)) as executor:
+        vde_sockets = list(executor.map(create_vlan, vlan_nrs))
     for nr, vde_socket, _, _ in vde_sockets:
         os.environ["QEMU_VDE_SOCKET_{}".format(nr)] = vde_socket
 
@@ -935,6 +1112,10 @@ if __name__ == "__main__":
     def clean_up() -> None:
         with log.nested("cleaning up"):
             for machine in machines:
+                if machine.transfer_dir is not None:
+                    shutil.rmtree(machine.transfer_dir, ignore_errors=True)
+                if os.path.exists(machine.screen_dump):
+                    os.unlink(machine.screen_dump)
                 if machine.pid is None:
                     continue
                 log.log("killing {} (pid {})".format(machine.name, machine.pid))